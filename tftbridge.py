@@ -5,8 +5,316 @@ Author: K. Hui
 """
 
 from typing import Any
+import errno
+import fcntl
+import functools
+import multiprocessing
+import os
+import select
 import serial
-import threading
+import struct
+import termios
+import time
+
+
+def open_device(device: str, baud: int, timeout: float):
+    """Open serial port to device."""
+    serial_port = serial.Serial(device, baud, timeout=timeout)
+    # pyserial already configures the tty fully raw (no ICANON/ISIG/ECHO
+    # cooking, XON/XOFF off), so the remaining per-byte delay sits in the
+    # UART driver's receive FIFO timer.  Ask the driver for low-latency
+    # mode where it supports it.
+    try:
+        serial_port.set_low_latency_mode(True)
+    except Exception:
+        pass  # Not supported by all drivers, e.g. the Klipper pty
+    return serial_port
+
+
+def make_port_factory(device: str, baud: int, timeout: int):
+    """Build a zero-argument factory that opens the given serial port.
+
+    The config is resolved once here instead of on every reconnect.  A
+    timeout of 0 in the config used to mean "block forever", but the
+    forwarding loop needs blocking reads to return periodically so it can
+    notice the stop event; translate it to a short timeout instead.
+    """
+    return functools.partial(
+        open_device, device, baud, 0.05 if timeout == 0 else timeout
+    )
+
+
+# Size of the per-direction receive buffers on the read/write path
+RX_BUF_SIZE = 4096
+
+# Write coalescing: flush a pending output buffer once it holds this many
+# bytes or once its oldest byte has waited this long.  2ms is far below what
+# is noticeable on the TFT, but lets streaming G-code share one syscall
+# across several lines.
+FLUSH_BYTES = 512
+FLUSH_DELAY = 0.002
+
+# Give up on the bridge after this many consecutive failures of the same
+# kind; at that point the port is gone and retrying forever helps nobody
+MAX_REPEAT_ERRORS = 50
+
+
+def splice_forward(fd: int, peer_fd: int, pipe: tuple[int, int]):
+    """Move one chunk from fd to peer_fd through a pipe, without the data
+    ever being copied into userspace."""
+    pipe_r, pipe_w = pipe
+    moved = os.splice(fd, pipe_w, 4096, flags=os.SPLICE_F_MOVE | os.SPLICE_F_NONBLOCK)
+    pending = moved
+    while pending > 0:
+        try:
+            pending -= os.splice(pipe_r, peer_fd, pending, flags=os.SPLICE_F_MOVE)
+        except BlockingIOError:
+            # The peer cannot take more right now; wait until it can so the
+            # bytes parked in the pipe keep their order
+            select.select([], [peer_fd], [])
+    return moved
+
+
+def forwarder_main(open_tft, open_klipper, stop_event, wake_fd: int):
+    """Entry point of the forwarder process: open both serial ports and
+    forward data between them in both directions until stop_event is set.
+
+    The byte stream is forwarded as-is, without line framing: chunks need
+    not align with G-code line boundaries, since both ends reassemble lines
+    from the stream themselves.
+    """
+
+    # The process owns both serial ports; they are opened here rather than
+    # in the parent so the descriptors never straddle the fork
+    try:
+        tft_serial = open_tft()
+    except Exception as e:
+        print(f"Failed to establish tft connection: {e}")
+        return
+    try:
+        klipper_serial = open_klipper()
+    except Exception as e:
+        print(f"Failed to establish klipper connection: {e}")
+        tft_serial.close()
+        return
+
+    tft_fd = tft_serial.fileno()
+    klipper_fd = klipper_serial.fileno()
+    names = {tft_fd: "tft", klipper_fd: "klipper"}
+    peers = {tft_fd: klipper_fd, klipper_fd: tft_fd}
+    # One receive buffer per direction, allocated once and reused, so the
+    # fallback path makes no allocations per chunk
+    rx_views = {
+        tft_fd: memoryview(bytearray(RX_BUF_SIZE)),
+        klipper_fd: memoryview(bytearray(RX_BUF_SIZE)),
+    }
+    # Scratch buffer for the FIONREAD ioctl below, mutated in place
+    fionread_buf = bytearray(4)
+    # Non-blocking fds let one poll() wake-up drain a whole burst of data
+    # instead of re-polling for every chunk
+    os.set_blocking(tft_fd, False)
+    os.set_blocking(klipper_fd, False)
+
+    # Register both file descriptors with the poller once up front; every
+    # wake-up after that reuses the same kernel-side registration instead of
+    # rebuilding fd sets per call like select() does.
+    poller = select.poll()
+    poller.register(tft_fd, select.POLLIN)
+    poller.register(klipper_fd, select.POLLIN)
+    # The parent writes to this eventfd on disconnect, so shutdown wakes
+    # the poll immediately instead of waiting out its timeout
+    poller.register(wake_fd, select.POLLIN)
+
+    # Each direction gets a kernel pipe so data can be spliced from one tty
+    # driver to the other without surfacing in userspace.  Not every tty
+    # driver supports splice, so keep a read/write fallback.
+    use_splice = hasattr(os, "splice")
+    pipes: dict[int, tuple[int, int]] = {}
+    if use_splice:
+        for fd in (tft_fd, klipper_fd):
+            pipe_r, pipe_w = os.pipe()
+            try:
+                fcntl.fcntl(pipe_w, fcntl.F_SETPIPE_SZ, 65536)
+            except OSError:
+                pass  # The default pipe size works too
+            pipes[fd] = (pipe_r, pipe_w)
+
+    # Pending outgoing chunks per destination fd (kept as separate segments
+    # and written with one writev() instead of concatenated), the total
+    # pending size, and the deadline by which each must be flushed
+    out_segs: dict[int, list[bytes]] = {tft_fd: [], klipper_fd: []}
+    out_sizes = {tft_fd: 0, klipper_fd: 0}
+    out_deadlines: dict[int, float | None] = {tft_fd: None, klipper_fd: None}
+
+    # Hot-unplug protection: once a port is gone every syscall on it fails
+    # instantly, which would otherwise spin the loop at full speed while
+    # spamming the log.  Log each distinct errno once, back off briefly,
+    # and stop the bridge if the same error keeps repeating.
+    giving_up = False
+    last_errno: int | None = None
+    errno_repeats = 0
+
+    def note_error(what: str, e: Exception):
+        """Log a hot-loop error rate-limited by errno and back off; sets
+        giving_up once the same error has repeated too often."""
+        nonlocal giving_up, last_errno, errno_repeats
+        err = getattr(e, "errno", None)
+        if err != last_errno:
+            print(f"Failed to {what}: {e}")
+            last_errno = err
+            errno_repeats = 0
+        errno_repeats += 1
+        if errno_repeats >= MAX_REPEAT_ERRORS:
+            print(f"Giving up on forwarding after repeated errors: {e}")
+            giving_up = True
+            return
+        time.sleep(0.1)
+
+    def flush(fd: int):
+        """Scatter-gather write the pending segments for fd in one syscall,
+        keeping any short-write rest."""
+        segs = out_segs[fd]
+        try:
+            written = os.writev(fd, segs)
+        except BlockingIOError:
+            written = 0  # Port cannot take more yet; retry on the next pass
+        except Exception as e:
+            note_error(f"write to {names[fd]}", e)
+            segs.clear()
+            out_sizes[fd] = 0
+            out_deadlines[fd] = None
+            return
+        out_sizes[fd] -= written
+        # Drop fully written segments and trim a partially written one
+        while written:
+            seg = segs[0]
+            if written < len(seg):
+                segs[0] = seg[written:]
+                break
+            written -= len(seg)
+            del segs[0]
+        out_deadlines[fd] = time.monotonic() + FLUSH_DELAY if segs else None
+
+    # Hoist the per-iteration attribute lookups into locals; LOAD_FAST is
+    # much cheaper than the LOAD_ATTR chains inside the hot loop
+    is_stopped = stop_event.is_set
+    poll = poller.poll
+    monotonic = time.monotonic
+    readv = os.readv
+
+    while not is_stopped() and not giving_up:
+        # Wait until either side has data, then forward it to the peer.
+        # One poll() covers both directions, so a single process services
+        # the whole bridge.  Cap the wait at the nearest flush deadline so
+        # coalesced writes still go out on time.
+        timeout_ms = 100
+        now = monotonic()
+        for deadline in out_deadlines.values():
+            if deadline is not None:
+                timeout_ms = min(timeout_ms, max(0, int((deadline - now) * 1000)))
+        try:
+            events = poll(timeout_ms)
+        except Exception as e:
+            note_error("wait for serial data", e)
+            continue
+        for fd, event in events:
+            if fd == wake_fd:
+                try:
+                    os.eventfd_read(wake_fd)  # Drain the wakeup
+                except BlockingIOError:
+                    pass
+                continue  # The loop condition rechecks stop_event
+            peer_fd = peers[fd]
+            # Drain everything the kernel has queued for this fd before
+            # going back to poll()
+            while True:
+                if use_splice:
+                    try:
+                        moved = splice_forward(fd, peer_fd, pipes[fd])
+                    except BlockingIOError:
+                        break  # Queue is empty
+                    except OSError as e:
+                        if e.errno in (errno.EINVAL, errno.ENOSYS):
+                            # This tty driver cannot splice; drop to the
+                            # read/write path for the rest of the run
+                            use_splice = False
+                            continue
+                        note_error(f"splice from {names[fd]}", e)
+                        break
+                    if not moved:
+                        # Zero bytes is ambiguous on a tty: it can mean
+                        # "nothing queued" as well as EOF.  Only treat it
+                        # as a disconnect when poll flagged the fd as hung
+                        # up, otherwise the POLLHUP would spin the loop at
+                        # full speed
+                        if event & (select.POLLHUP | select.POLLERR):
+                            note_error(
+                                f"splice from {names[fd]}",
+                                OSError(errno.EIO, "device disconnected"),
+                            )
+                        break
+                    if last_errno is not None:
+                        # The port is talking again; forget the error streak
+                        last_errno = None
+                        errno_repeats = 0
+                    continue
+                try:
+                    count = readv(fd, [rx_views[fd]])
+                except BlockingIOError:
+                    break  # Queue is empty
+                except Exception as e:
+                    note_error(f"read from {names[fd]}", e)
+                    break
+                if not count:
+                    # Same hot-unplug check as the splice path above
+                    if event & (select.POLLHUP | select.POLLERR):
+                        note_error(
+                            f"read from {names[fd]}",
+                            OSError(errno.EIO, "device disconnected"),
+                        )
+                    break
+                if last_errno is not None:
+                    # The port is talking again; forget the error streak
+                    last_errno = None
+                    errno_repeats = 0
+                # Coalesce into the peer's segment list; small bursts ride
+                # along with the next flush instead of paying their own
+                # syscall.  The segment must be copied out of the shared
+                # receive buffer, but writev() sends the whole list without
+                # a second concatenation copy.
+                out_segs[peer_fd].append(bytes(rx_views[fd][:count]))
+                out_sizes[peer_fd] += count
+                if out_deadlines[peer_fd] is None:
+                    out_deadlines[peer_fd] = monotonic() + FLUSH_DELAY
+                if out_sizes[peer_fd] >= FLUSH_BYTES:
+                    flush(peer_fd)
+                if count < RX_BUF_SIZE:
+                    break  # A short read means the queue is drained
+                # The buffer came back full; ask the driver how much is
+                # still queued rather than paying a read syscall just to
+                # learn the answer is EAGAIN
+                try:
+                    fcntl.ioctl(fd, termios.FIONREAD, fionread_buf)
+                except OSError:
+                    continue  # No FIONREAD here; fall back to read-to-EAGAIN
+                if not struct.unpack("i", fionread_buf)[0]:
+                    break
+
+        # Flush any buffer whose deadline has passed
+        now = monotonic()
+        for fd, deadline in out_deadlines.items():
+            if deadline is not None and now >= deadline:
+                flush(fd)
+
+    # Write out anything still pending, then close connections and pipes
+    for fd, segs in out_segs.items():
+        if segs:
+            flush(fd)
+    tft_serial.close()
+    klipper_serial.close()
+    for pipe_r, pipe_w in pipes.values():
+        os.close(pipe_r)
+        os.close(pipe_w)
 
 
 class TftBridge:
@@ -21,101 +329,56 @@ class TftBridge:
         self.klipper_baud: int = config.getint("klipper_baud")
         self.klipper_timeout: int = config.getint("klipper_timeout")
 
-        # Connections to TFT35 and Klipper serial ports
-        self.tft_serial: serial.Serial | None = None
-        self.klipper_serial: serial.Serial | None = None
+        # Precomputed port factories; the timeout handling runs once here
+        # instead of on every reconnect
+        self.open_tft = make_port_factory(
+            self.tft_device, self.tft_baud, self.tft_timeout
+        )
+        self.open_klipper = make_port_factory(
+            self.klipper_device, self.klipper_baud, self.klipper_timeout
+        )
 
-        # Event to signal stopping threads
-        self.stop_event = threading.Event()
+        # Event to signal stopping the forwarder process, plus an eventfd
+        # the forwarder polls so the signal wakes it up instantly
+        self.stop_event = multiprocessing.Event()
+        self.wake_fd = os.eventfd(0, os.EFD_NONBLOCK)
+
+        # The forwarder runs in its own process so serial I/O never competes
+        # with the main Klippy process for the GIL or a scheduler slice
+        self.forwarder_process: multiprocessing.Process | None = None
 
         # Register event handlers
         self.printer.register_event_handler("klippy:ready", self.handle_ready)
         self.printer.register_event_handler("klippy:disconnect", self.handle_disconnect)
 
-    def open_device(self, device: str, baud: int, timeout: int):
-        """Open serial port to device."""
-        if timeout == 0:
-            serial_port = serial.Serial(device, baud)
-        else:
-            serial_port = serial.Serial(device, baud, timeout=timeout)
-        return serial_port
-
     def handle_ready(self):
         """Event handler when printer is ready."""
+        if self.forwarder_process is not None and self.forwarder_process.is_alive():
+            return  # Still running from a previous ready event
 
-        # Create connections to devices if needed
-        if self.tft_serial is None:
-            try:
-                self.tft_serial = self.open_device(
-                    self.tft_device, self.tft_baud, self.tft_timeout
-                )
-            except Exception as e:
-                print(f"Failed to establish tft connection: {e}")
-                self.tft_serial = None
-
-        if self.klipper_serial is None:
-            try:
-                self.klipper_serial = self.open_device(
-                    self.klipper_device, self.klipper_baud, self.klipper_timeout
-                )
-            except Exception as e:
-                print(f"Failed to establish klipper connection: {e}")
-                self.klipper_serial = None
-
-        # Create and start threads
+        # Create and start the forwarder process; it opens the serial ports
+        # itself, so the parent never holds the descriptors
         self.stop_event.clear()
-        threading.Thread(target=self.tft2klipper).start()
-        threading.Thread(target=self.klipper2tft).start()
-
-    def tft2klipper(self):
-        """Forward data from TFT35 to Klipper."""
-        while True:
-            # If stopping thread event is set
-            if self.stop_event.is_set():
-                if self.tft_serial is not None:
-                    self.tft_serial.close()  # Close connection to TFT35
-                self.tft_serial = None  # Clear property
-                break
-
-            # Otherwise read from TFT35 and forward to Klipper
-            if self.tft_serial is not None and self.klipper_serial is not None:
-                try:
-                    line = self.tft_serial.readline()
-                except Exception as e:
-                    print(f"Failed to read from tft {e}")
-                    line = ""
-                if line != "":  # If readline timeout, it returns an empty str
-                    try:
-                        self.klipper_serial.write(line)
-                    except Exception as e:
-                        print(f"Failed to write to klipper {e}")
-
-    def klipper2tft(self):
-        """Forward data from Klipper to TFT35."""
-        while True:
-            # If stopping thread event is set
-            if self.stop_event.is_set():
-                if self.klipper_serial is not None:
-                    self.klipper_serial.close()  # Close connection to Klipper
-                self.klipper_serial = None  # Clear property
-                break
-
-            # Otherwise read from Klipper and forward to TFT35
-            if self.tft_serial is not None and self.klipper_serial is not None:
-                try:
-                    line = self.klipper_serial.readline()
-                except Exception as e:
-                    print(f"Failed to read from klipper {e}")
-                    line = ""
-                if line != "":  # If readline timeout, it returns an empty str
-                    try:
-                        self.tft_serial.write(line)
-                    except Exception as e:
-                        print(f"Failed to write to tft {e}")
+        self.forwarder_process = multiprocessing.Process(
+            target=forwarder_main,
+            args=(self.open_tft, self.open_klipper, self.stop_event, self.wake_fd),
+            daemon=True,
+        )
+        self.forwarder_process.start()
 
     def handle_disconnect(self):
         """Event handler when printer is disconnected."""
-        self.stop_event.set()  # Signal threads to stop
+        self.stop_event.set()  # Signal forwarder process to stop
+        try:
+            os.eventfd_write(self.wake_fd, 1)  # Wake its poll right away
+        except Exception as e:
+            print(f"Failed to wake forwarder: {e}")
+        if self.forwarder_process is not None:
+            self.forwarder_process.join(timeout=1.0)
+            if self.forwarder_process.is_alive():
+                print("Forwarder did not stop cleanly, terminating it")
+                self.forwarder_process.terminate()
+            self.forwarder_process = None
 
 
 def load_config(config: Any):